@@ -3,11 +3,18 @@ Ultimate HK Tennis Court Sniper — Streamlit Cloud Compatible
 Cascading filters + browser (Web) notifications. No plyer.
 """
 
+import hashlib
 import json
+import os
+import threading
 import time
 import streamlit as st
 import streamlit.components.v1 as components
+import numpy as np
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
 from datetime import datetime
 from streamlit_autorefresh import st_autorefresh
@@ -19,10 +26,38 @@ HK_TZ = pytz.timezone("Asia/Hong_Kong")
 # Static playing hours for sniper time selection (not driven by current data)
 SNIPER_TIME_OPTIONS = [f"{h:02d}:00" for h in range(7, 24)]
 
+# Live Monitor re-check interval (seconds)
+LIVE_MONITOR_SECONDS = 60
+
+# Reports browser tab visibility back to Python (value True/False, one rerun per hide/show)
+TAB_VISIBILITY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "components", "tab_visibility")
+tab_visibility = components.declare_component("tab_visibility", path=TAB_VISIBILITY_DIR)
+
 st.set_page_config(page_title="HK Tennis Sniper", layout="wide")
 
-# Auto-refresh every 30 minutes so deployed app gets new data
-st_autorefresh(interval=30 * 60 * 1000, key="data_refresh")
+# Tab visibility from the previous hide/show event (the component itself is mounted at the end of the sidebar)
+tab_visible = st.session_state.get("tab_visibility", True)
+tab_returned = tab_visible and not st.session_state.get("tab_was_visible", True)
+st.session_state.tab_was_visible = tab_visible
+
+# Auto-refresh every 30 minutes so deployed app gets new data; not mounted while the tab is hidden,
+# so idle background tabs cause no reruns or API hits. The returned count only grows on timer
+# reruns, so comparing it with the last seen value tells them apart from widget reruns.
+data_refresh_due = False
+if tab_visible:
+    data_refresh_count = st_autorefresh(interval=30 * 60 * 1000, key="data_refresh")
+    data_refresh_due = data_refresh_count != st.session_state.get("data_refresh_seen", 0)
+    st.session_state.data_refresh_seen = data_refresh_count
+
+# Live Monitor re-checks via a client-side timer (the checkbox widget itself is rendered in the sidebar below)
+live_monitor_on = st.session_state.get("live_monitor", False)
+if live_monitor_on:
+    st_autorefresh(interval=LIVE_MONITOR_SECONDS * 1000, key="live_monitor_tick")
+
+# Raw API data is revalidated at most this often (seconds)
+CACHE_TTL_SECONDS = 30 * 60
+# (connect, read) timeouts for the API call
+API_TIMEOUT = (3.05, 15)
 
 API_URL = "https://data.smartplay.lcsd.gov.hk/rest/cms/api/v1/publ/contents/open-data/tennis/file"
 NOTIFICATION_ICON = "https://img.icons8.com/emoji/48/000000/tennis-icon.png"
@@ -35,21 +70,66 @@ DISPLAY_COLS = [
     "Available_Courts",
 ]
 
+# Columns identifying one bookable slot (Live Monitor alerts when new ones appear)
+SLOT_KEY_COLS = ["Venue_Name_EN", "Available_Date", "Session_Start_Time"]
+
+# Keys that may wrap the record list when the API returns a dict, in lookup order
+RECORD_KEYS = ("data", "contents", "result", "items", "records")
+
+# Text columns used by the sniper filters (everything in DISPLAY_COLS except the court count)
+FILTER_COLS = [c for c in DISPLAY_COLS if c != "Available_Courts"]
+
+# One pooled session for all API calls (keeps the TLS connection alive between refreshes)
+SESSION = requests.Session()
+SESSION.headers["Accept-Encoding"] = "gzip"
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=2,
+        pool_maxsize=4,
+        max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+    ),
+)
+
 
 def extract_records(raw):
     """Handle API response: may be a list or a dict with data/contents/result."""
-    if isinstance(raw, list):
+    if raw.__class__ is list:
         return raw
-    if isinstance(raw, dict):
-        for key in ("data", "contents", "result", "items", "records"):
-            if key in raw and isinstance(raw[key], list):
-                return raw[key]
-    return []
+    if not isinstance(raw, dict):
+        return []
+    return next((raw[k] for k in RECORD_KEYS if isinstance(raw.get(k), list)), [])
+
+
+# Available_Courts is stored as int16; out-of-range values are clipped instead of wrapping
+COURTS_MIN, COURTS_MAX = int(np.iinfo(np.int16).min), int(np.iinfo(np.int16).max)
+
+
+def to_court_count(value):
+    """Available_Courts arrives as a string (or missing); anything non-numeric counts as 0."""
+    try:
+        count = int(float(value))
+    except (TypeError, ValueError, OverflowError):
+        return 0
+    return min(max(count, COURTS_MIN), COURTS_MAX)
 
 
-def html_notification_permission_button():
-    """Step A: A real button — browser only shows 'Allow' popup when user clicks (user gesture)."""
-    return """
+def build_dataframe(records):
+    """Columnar DataFrame of DISPLAY_COLS with explicit dtypes (no per-row dtype inference).
+
+    Available_Courts is int16: a venue never has more than a few dozen courts.
+    """
+    frame = {col: pd.array([rec.get(col) for rec in records], dtype="string") for col in FILTER_COLS}
+    frame["Available_Courts"] = np.fromiter(
+        (to_court_count(rec.get("Available_Courts")) for rec in records),
+        dtype=np.int16,
+        count=len(records),
+    )
+    return pd.DataFrame(frame, columns=DISPLAY_COLS)
+
+
+# Step A: A real button — browser only shows 'Allow' popup when user clicks (user gesture). Fully static.
+PERM_BUTTON_HTML = """
     <div style="margin: 8px 0;">
         <button type="button" id="btn-allow-notifications" style="
             padding: 8px 14px; background: #ff4b4b; color: white; border: none; border-radius: 6px;
@@ -73,72 +153,220 @@ def html_notification_permission_button():
     </script>
     """
 
-
-def js_show_notification(venue_name: str):
-    """Step B: Show browser notification when court is found. Body/venue safely escaped."""
-    body = f"Go book at {venue_name} now!"
-    body_escaped = json.dumps(body)  # safe for embedding in JS string
-    return f"""
+# Step B template; __ICON__ is filled in once here, __BODY__ with a JSON-escaped string at call time
+# (placeholders rather than %-formatting, so a literal % in the script can never break it)
+NOTIF_TEMPLATE = """
     <script>
-    (function() {{
-        if ("Notification" in window && Notification.permission === "granted") {{
-            new Notification("🎾 Court Found!", {{
-                body: {body_escaped},
-                icon: "{NOTIFICATION_ICON}"
-            }});
-        }}
-    }})();
+    (function() {
+        if ("Notification" in window && Notification.permission === "granted") {
+            new Notification("🎾 Court Found!", {
+                body: __BODY__,
+                icon: "__ICON__"
+            });
+        }
+    })();
     </script>
-    """
+    """.replace("__ICON__", NOTIFICATION_ICON)
 
 
-@st.cache_data(ttl=1800)
-def fetch_data():
-    """Fetch JSON from HK SmartPlay API."""
+def notification_body(filtered_df, max_venues=3):
+    """One summary line for all matches, e.g. "5 slots at A, B, C +2 more — go book now!"."""
+    venues = filtered_df["Venue_Name_EN"].dropna().unique().tolist()
+    where = ", ".join(venues[:max_venues]) or "Court"
+    if len(venues) > max_venues:
+        where += f" +{len(venues) - max_venues} more"
+    n = len(filtered_df)
+    return f"{n} slot{'s' if n != 1 else ''} at {where} — go book now!"
+
+
+def js_show_notification(body: str):
+    """Step B: Show one browser notification when courts are found. Body safely escaped."""
+    # json.dumps output is safe for embedding in a JS string
+    return NOTIF_TEMPLATE.replace("__BODY__", json.dumps(body))
+
+
+@st.cache_resource
+def payload_cache():
+    """Last API payload + its validators (ETag / Last-Modified), shared across sessions.
+
+    "payload" is the (payload_hash, records) tuple, swapped as one value so readers never see a mix.
+    "lock" is held while a refresh is in flight so concurrent reruns do not start duplicates.
+    """
+    return {"etag": None, "last_modified": None, "payload": None, "fetched_at": 0.0, "lock": threading.Lock()}
+
+
+def revalidate(cache):
+    """Conditional GET against the API, updating cache in place. Returns False if the call failed."""
+    # fetched_at is the send time, so a payload's age is never understated by request latency
+    # (see the Live Monitor max_age for the polling margin)
+    sent_at = time.time()
+    headers = {}
+    if cache["etag"]:
+        headers["If-None-Match"] = cache["etag"]
+    if cache["last_modified"]:
+        headers["If-Modified-Since"] = cache["last_modified"]
     try:
-        r = requests.get(API_URL, timeout=15)
+        r = SESSION.get(API_URL, headers=headers, timeout=API_TIMEOUT)
+        if r.status_code == 304 and cache["payload"] is not None:
+            cache["fetched_at"] = sent_at
+            return True
         r.raise_for_status()
-        raw = r.json()
-        return extract_records(raw)
+        records = extract_records(orjson.loads(r.content))
     except requests.RequestException:
-        return None
+        return False
     except (ValueError, TypeError):
-        return None
+        return False
+
+    cache.update(
+        etag=r.headers.get("ETag"),
+        last_modified=r.headers.get("Last-Modified"),
+        payload=(hashlib.blake2b(r.content, digest_size=16).hexdigest(), records),
+        fetched_at=sent_at,
+    )
+    return True
+
+
+def revalidate_in_background(cache):
+    """Thread target: refresh the shared payload, then release the refresh lock."""
+    try:
+        revalidate(cache)
+    finally:
+        cache["lock"].release()
+
+
+def fetch_data(max_age=CACHE_TTL_SECONDS, background=True):
+    """Fetch JSON from HK SmartPlay API; conditional GET so unchanged data costs a 304.
+
+    Cached records younger than max_age seconds are returned without a request. With background=True
+    older ones are still returned immediately while a background thread revalidates them
+    (stale-while-revalidate); with background=False, or on a cold cache, the call waits on the API.
+    A failed synchronous refresh falls back to the stale records.
+
+    Returns (payload, ok): payload is (payload_hash, records), or None if there is no data yet and the
+    API call fails; ok is False when a synchronous refresh failed (payload is then stale or None).
+    """
+    cache = payload_cache()
+    if cache["payload"] is not None and time.time() - cache["fetched_at"] < max_age:
+        return cache["payload"], True
+    ok = True
+    if cache["payload"] is None or not background:
+        # Waits for an in-flight background refresh first; skips the request if that one was enough
+        with cache["lock"]:
+            if cache["payload"] is None or time.time() - cache["fetched_at"] >= max_age:
+                ok = revalidate(cache)
+    elif cache["lock"].acquire(blocking=False):
+        threading.Thread(target=revalidate_in_background, args=(cache,), daemon=True).start()
+    return cache["payload"], ok
+
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def build_frames(payload_hash, _records):
+    """Available rows + district/venue scope from the raw payload, built once per payload_hash.
+
+    Returns (available_df, venue_scope). available_df keeps the full raw category sets, so District
+    and Date options still list fully booked values; venue_scope holds every distinct raw
+    (district, venue) pair for the Step 2 options.
+    """
+    df = build_dataframe(_records)
+
+    # Ordered categorical filter columns: isin() compares integer codes, not Python strings, and the
+    # categories are the sorted distinct non-null values (options need no unique()/sort/dropna pass)
+    for col in FILTER_COLS:
+        df[col] = pd.Categorical(df[col], ordered=True)
+
+    venue_scope = df[["District_Name_EN", "Venue_Name_EN"]].drop_duplicates(ignore_index=True)
+
+    # Rows with at least one court available (for alert logic and table)
+    available_df = df.loc[df["Available_Courts"].to_numpy() > 0]
+    available_df.attrs["payload_hash"] = payload_hash
+    return available_df, venue_scope
+
+
+def mask_isin(df, col, selected):
+    """Bool mask over df rows whose `col` is in `selected`; all True when nothing is selected."""
+    if not selected:
+        return np.ones(len(df), dtype=bool)
+    return df[col].isin(selected).to_numpy()
+
+
+def options_in(df, col, mask):
+    """Sorted distinct values of ordered categorical `col` among the rows in `mask` (no frame slicing).
+
+    Codes index the sorted categories, so np.unique over the codes already yields sorted values; -1 is null.
+    """
+    codes = df[col].cat.codes.to_numpy()[mask]
+    return df[col].cat.categories.take(np.unique(codes[codes >= 0])).tolist()
+
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS, max_entries=64, show_spinner=False)
+def compute_matches(payload_hash, districts, venues, dates, times, _available_df):
+    """Available rows matching ALL selections, memoized per payload + selection tuples.
+
+    _available_df is the build_frames output for payload_hash, so it is left out of the key.
+    """
+    mask = (
+        mask_isin(_available_df, "District_Name_EN", districts)
+        & mask_isin(_available_df, "Venue_Name_EN", venues)
+        & mask_isin(_available_df, "Available_Date", dates)
+        & mask_isin(_available_df, "Session_Start_Time", times)
+    )
+    return _available_df.iloc[mask]
+
+
+@st.cache_data(ttl=60, show_spinner=False)
+def hk_now_minute():
+    """Current Hong Kong time for the header, recomputed at most once a minute."""
+    return datetime.now(HK_TZ).strftime("%Y-%m-%d %H:%M")
 
 
 st.title("🎾 Ultimate HK Tennis Court Sniper")
-st.caption(f"Last updated: **{datetime.now(HK_TZ).strftime('%Y-%m-%d %H:%M:%S')}** (Hong Kong Time)")
+st.caption(f"Last updated: **{hk_now_minute()}** (Hong Kong Time)")
 
 # --- Refresh Data ---
-if st.button("🔄 Refresh Data"):
-    fetch_data.clear()
-    st.rerun()
-
-# --- Fetch and validate ---
-raw_records = fetch_data()
+# Revalidates inline (max_age=0, no background thread) so this run already shows the fresh data
+refresh_requested = st.button("🔄 Refresh Data")
+
+# --- Fetch and validate (Live Monitor revalidates every tick; a 304 when nothing changed) ---
+if live_monitor_on:
+    # Still polls in a hidden tab: background alerts are the point of Live Monitor. Ticks come every
+    # LIVE_MONITOR_SECONDS from the browser while fetched_at is a server send time, so ages seen by
+    # consecutive ticks drift around the interval; half of it as max_age makes every tick revalidate.
+    max_age = LIVE_MONITOR_SECONDS / 2
+else:
+    max_age = CACHE_TTL_SECONDS
+# Timer reruns (30-min refresh, Live Monitor tick), the rerun on returning to the tab and an explicit
+# refresh must show new data on this run, since nothing reruns the page when a background refresh
+# finishes, so they revalidate synchronously when stale (usually a cheap 304). Widget reruns keep
+# stale-while-revalidate.
+if refresh_requested:
+    with st.spinner("Refreshing data…"):
+        payload, fetch_ok = fetch_data(0, background=False)
+else:
+    payload, fetch_ok = fetch_data(max_age, background=not (live_monitor_on or data_refresh_due or tab_returned))
 
-if raw_records is None:
+if payload is None:
     st.error("Error fetching data from the API. Check your connection and try again.")
     st.stop()
 
+if not fetch_ok:
+    st.warning("Couldn't reach the API — showing the last data fetched. Check your connection and try again.")
+
+payload_hash, raw_records = payload
+
 if not raw_records:
     st.warning("No data loaded from the API.")
     st.stop()
 
-# --- Load into DataFrame and clean ---
-df = pd.DataFrame(raw_records)
-
-# CRITICAL: Available_Courts is STRING from API → convert to int
-df["Available_Courts"] = pd.to_numeric(df["Available_Courts"], errors="coerce").fillna(0).astype(int)
-
-# Rows with at least one court available (for alert logic and table)
-available_df = df[df["Available_Courts"] > 0].copy()
+# --- Load into DataFrame and clean (cached per payload) ---
+# CRITICAL: Available_Courts is STRING from API → converted to int inside build_dataframe
+available_df, venue_scope = build_frames(payload_hash, raw_records)
 
-# ========== 🎯 Sniper Settings (populated from RAW df so fully-booked venues appear) ==========
+# ========== 🎯 Sniper Settings (populated from RAW data so fully-booked venues appear) ==========
 st.sidebar.header("🎯 Sniper Settings")
 
-# Step 1: District — from raw df (all districts, including fully booked)
-all_districts = sorted(df["District_Name_EN"].dropna().unique())
+# Step 1: District — from raw data (all districts, including fully booked)
+# Categories are the sorted distinct non-null raw values: O(k), no per-row dropna()/unique()/sorted()
+all_districts = available_df["District_Name_EN"].cat.categories.tolist()
 selected_districts = st.sidebar.multiselect(
     "Step 1: District",
     options=all_districts,
@@ -146,12 +374,9 @@ selected_districts = st.sidebar.multiselect(
     key="snipe_district",
 )
 
-# Step 2: Venue — from raw df, only in selected district(s) (so user can target a booked venue)
-if selected_districts:
-    scope_df = df[df["District_Name_EN"].isin(selected_districts)]
-else:
-    scope_df = df
-venue_options = sorted(scope_df["Venue_Name_EN"].dropna().unique())
+# Step 2: Venue — from raw data, only in selected district(s) (so user can target a booked venue)
+m_district = mask_isin(venue_scope, "District_Name_EN", selected_districts)
+venue_options = options_in(venue_scope, "Venue_Name_EN", m_district)
 selected_venues = st.sidebar.multiselect(
     "Step 2: Venue",
     options=venue_options,
@@ -159,9 +384,9 @@ selected_venues = st.sidebar.multiselect(
     key="snipe_venue",
 )
 
-# Step 3: Date — all dates in dataset (pd.to_datetime then sorted)
-date_vals = pd.to_datetime(df["Available_Date"].dropna(), errors="coerce").dropna().unique()
-date_options = sorted([d.strftime("%Y-%m-%d") for d in date_vals])
+# Step 3: Date — all dates in dataset (pd.to_datetime on the distinct values only, then sorted)
+date_vals = pd.to_datetime(available_df["Available_Date"].cat.categories, errors="coerce").dropna()
+date_options = np.unique(date_vals.strftime("%Y-%m-%d").to_numpy(dtype=str)).tolist()
 selected_dates = st.sidebar.multiselect(
     "Step 3: Date",
     options=date_options,
@@ -178,15 +403,15 @@ selected_times = st.sidebar.multiselect(
 )
 
 # --- Build final filtered DataFrame from ALL selections ---
-filtered_df = available_df.copy()
-if selected_districts:
-    filtered_df = filtered_df[filtered_df["District_Name_EN"].isin(selected_districts)]
-if selected_venues:
-    filtered_df = filtered_df[filtered_df["Venue_Name_EN"].isin(selected_venues)]
-if selected_dates:
-    filtered_df = filtered_df[filtered_df["Available_Date"].isin(selected_dates)]
-if selected_times:
-    filtered_df = filtered_df[filtered_df["Session_Start_Time"].isin(selected_times)]
+# Live Monitor ticks rerun with unchanged selections, so identical reruns reuse the cached result
+filtered_df = compute_matches(
+    available_df.attrs["payload_hash"],
+    tuple(selected_districts),
+    tuple(selected_venues),
+    tuple(selected_dates),
+    tuple(selected_times),
+    available_df,
+)
 
 # --- 🔴 Enable Live Monitor ---
 st.sidebar.divider()
@@ -194,38 +419,60 @@ enable_live_monitor = st.sidebar.checkbox("🔴 Enable Live Monitor", value=Fals
 
 # --- Allow notifications: must be a real click (user gesture) for browser to show "Allow" popup ---
 st.sidebar.caption("To get desktop alerts when a court is found:")
-components.html(html_notification_permission_button(), height=70)
+components.html(PERM_BUTTON_HTML, height=70)
 
 if "last_checked" not in st.session_state:
     st.session_state.last_checked = None
-st.session_state.last_checked = datetime.now(HK_TZ).strftime("%Y-%m-%d %H:%M:%S")
+# Only shown while Live Monitor is on; a failed check keeps the time of the last successful one
+if enable_live_monitor and fetch_ok:
+    st.session_state.last_checked = datetime.now(HK_TZ).strftime("%Y-%m-%d %H:%M:%S")
+
+# Alert only when slots appear that were not matched on the previous run: the 60 s tick keeps
+# polling while matches exist, and re-firing for the same slots (or when one gets booked) is noise.
+# An empty set when monitoring is off or nothing matches re-arms the alert.
+if enable_live_monitor and not filtered_df.empty:
+    match_slots = set(filtered_df[SLOT_KEY_COLS].itertuples(index=False, name=None))
+else:
+    match_slots = set()
+new_matches = not match_slots <= st.session_state.get("last_alert_slots", set())
+st.session_state.last_alert_slots = match_slots
 
-# --- Found logic & alerts (when Live Monitor ON and filtered table NOT empty) ---
-target_found = not filtered_df.empty
 
-if enable_live_monitor and target_found:
-    st.balloons()
-    st.toast("🎯 Target Acquired!")
-    # Browser notification (only works if user previously clicked "Allow browser notifications")
-    venue_names = filtered_df["Venue_Name_EN"].dropna().unique().tolist()
-    msg_venue = venue_names[0] if venue_names else "Court"
-    components.html(js_show_notification(msg_venue), height=0)
+def render_results(filtered_df, enable_live_monitor, new_matches):
+    """Found logic, alerts and the Live Monitor status line."""
+    # --- Found logic & alerts (when Live Monitor ON and the filtered match set is new) ---
+    if new_matches:
+        st.balloons()
+        st.toast("🎯 Target Acquired!")
+        # Browser notification (only works if user previously clicked "Allow browser notifications");
+        # a single coalesced summary for all matching venues, one component per rerun
+        components.html(js_show_notification(notification_body(filtered_df)), height=0)
 
-# --- Main area: filtered table ---
-cols_present = [c for c in DISPLAY_COLS if c in filtered_df.columns]
+    if enable_live_monitor:
+        st.caption(f"Last checked at **{st.session_state.last_checked}**")
 
-if enable_live_monitor:
-    st.caption(f"Last checked at **{st.session_state.last_checked}**")
 
-if filtered_df.empty:
-    st.info("No slots match your sniper settings. Widen filters or enable Live Monitor to re-check every 30 mins.")
-    if enable_live_monitor:
-        st.warning("Next check in 30 minutes...")
-        time.sleep(30 * 60)
-        st.rerun()
-else:
-    st.subheader(f"Found {len(filtered_df)} Available Slots!")
-    st.dataframe(filtered_df[cols_present], use_container_width=True)
-    st.success("✅ Go to SmartPlay to book now.")
+def render_table(filtered_df, enable_live_monitor):
+    """Filtered table, or the empty-state messages when nothing matches."""
+    if filtered_df.empty:
+        st.info("No slots match your sniper settings. Widen filters or enable Live Monitor to re-check every minute.")
+        if enable_live_monitor:
+            st.warning("Next check in 1 minute...")
+    else:
+        st.subheader(f"Found {len(filtered_df)} Available Slots!")
+        # Frame is already projected to DISPLAY_COLS in build_dataframe; the index is only the API row
+        # position, so it is not serialized either
+        st.dataframe(filtered_df, use_container_width=True, hide_index=True)
+        st.success("✅ Go to SmartPlay to book now.")
+
+
+render_results(filtered_df, enable_live_monitor, new_matches)
+
+# --- Main area: filtered table ---
+render_table(filtered_df, enable_live_monitor)
 
 st.sidebar.caption("💡 Click **Allow browser notifications** above, then choose **Allow** in the browser popup.")
+
+# Zero-height component kept at the end of the sidebar so its iframe does not leave a gap in the main column
+with st.sidebar:
+    tab_visibility(key="tab_visibility", default=True)